@@ -5,13 +5,20 @@ A client that can call functions on the WebSocket RPC server.
 """
 
 import asyncio
-import json
+import itertools
 import logging
-import uuid
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 import websockets
 
+try:
+    # uvloop (libuv-based event loop) is only available on Linux/macOS
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from protocol import Codec, SUBPROTOCOLS, JSON
+
 # The server URL
 SERVER_URL = "ws://localhost:8000"
 
@@ -19,15 +26,219 @@ SERVER_URL = "ws://localhost:8000"
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 
+class RPCClient:
+    """
+    A client that keeps a single WebSocket connection open to the server.
+    
+    Every call is tagged with a unique request ID and registered as a pending
+    future. A background task reads responses off the connection and resolves
+    the matching future, so many calls can be in flight on one socket at once
+    instead of paying a new handshake per call.
+    
+    Messages are sent as MessagePack when the server supports it, and as
+    JSON otherwise (or when use_msgpack is False).
+    
+    Usage:
+        async with RPCClient() as client:
+            response = await client.call_action("add_numbers", {"a": 1, "b": 2})
+    """
+
+    def __init__(self, url: str = SERVER_URL, use_msgpack: bool = True):
+        self.url = url
+        self.use_msgpack = use_msgpack
+        # The wire format, settled during the handshake
+        self._codec: Codec = JSON
+        self._ws: Optional[websockets.WebSocketClientProtocol] = None
+        self._reader: Optional[asyncio.Task] = None
+        # Request IDs only need to be unique on this connection, so a counter
+        # is enough (and much cheaper than generating UUIDs)
+        self._next_id = itertools.count()
+        # Calls waiting for a response, keyed by request ID. With integer IDs
+        # a dict is already about as cheap as it gets in CPython: hashing an
+        # int is free, and a hand-rolled slot ring measured ~2x slower
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def connect(self) -> None:
+        """Open the connection and start the background response reader."""
+        # Offer the codecs we can use, preferably with coalesced replies
+        # (the reader handles arrays of responses anyway); a server that
+        # doesn't know about subprotocols just picks none, which means JSON
+        subprotocols = [name for name, (codec, _) in SUBPROTOCOLS.items() if self.use_msgpack or codec is JSON]
+
+        # Messages are small, so skip permessage-deflate (see server.py)
+        self._ws = await websockets.connect(self.url, compression=None, subprotocols=subprotocols)
+        self._codec = SUBPROTOCOLS.get(self._ws.subprotocol, (JSON, False))[0]
+        self._reader = asyncio.create_task(self._read_responses())
+
+    async def close(self) -> None:
+        """Close the connection and stop the background response reader."""
+        if self._ws is not None:
+            await self._ws.close()
+        if self._reader is not None:
+            await self._reader
+        self._ws = None
+        self._reader = None
+
+    async def __aenter__(self) -> "RPCClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    async def _read_responses(self) -> None:
+        """
+        Route every incoming response to the call that is waiting for it.
+        
+        Runs until the connection closes; any calls still waiting at that
+        point fail with a ConnectionError. A frame that can't be decoded, or
+        an item in it that isn't a response, is logged and skipped.
+        """
+        # Looked up once here rather than on every response
+        pending = self._pending
+        loads = self._codec.loads
+        try:
+            async for raw in self._ws:
+                try:
+                    message = loads(raw)
+                except Exception:
+                    logging.exception("Dropping undecodable frame from server: %r", raw)
+                    continue
+
+                # A batch is answered with an array of responses in one frame
+                responses = message if type(message) is list else (message,)
+                for response in responses:
+                    # Match the response to its request using the request ID.
+                    # A bad item is skipped on its own, so the responses after
+                    # it in the same frame still reach their callers
+                    try:
+                        future = pending.pop(response.get("request_id"), None)
+                    except (AttributeError, TypeError):
+                        # Not an object, or an unhashable request_id
+                        logging.warning("Dropping malformed response from server: %r", response)
+                        continue
+                    if future is None:
+                        # The caller already gave up (timeout) or the ID is unknown
+                        logging.warning("Dropping response with unexpected ID: %s", response)
+                    elif not future.done():
+                        future.set_result(response)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            # Nobody is going to answer the remaining calls
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to server closed"))
+            pending.clear()
+
+    async def call_action(self, action: str, params: Dict[str, Any], timeout: float = 5.0) -> Dict[str, Any]:
+        """
+        Make a remote procedure call to the server.
+        
+        This function handles the complete request-response cycle:
+        1. Creates a unique request ID
+        2. Registers a pending future for that ID and sends the request
+        3. Waits for the background reader to deliver the matching response
+        4. Returns the server's response
+        
+        Args:
+            action: The name of the function to call (e.g., "add_numbers")
+            params: The parameters to pass to the function (e.g., {"a": 5, "b": 3})
+            timeout: Maximum time to wait for a response (in seconds)
+            
+        Returns:
+            The server's response as a dictionary
+            
+        Raises:
+            RuntimeError: If the client is not connected
+            ConnectionError: If the connection closes before the response arrives
+            asyncio.TimeoutError: If the server doesn't respond in time
+        """
+        if self._ws is None:
+            raise RuntimeError("Client is not connected")
+
+        # Generate a unique ID for this request - this is crucial for matching responses
+        # If multiple calls are made simultaneously, each needs its own ID
+        request_id = next(self._next_id)
+        
+        # Create the request message following our protocol
+        payload = {
+            "request_id": request_id,  # So the server knows which request this is
+            "action": action,          # Which function to call
+            "params": params,          # The arguments to pass
+        }
+
+        # Register the call before sending so the response can't arrive first
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            # Send the request to the server as a binary frame, which the
+            # server hands to the decoder without a separate UTF-8 check
+            await self._ws.send(self._codec.dumps(payload))
+
+            # Wait for the response (with a timeout to prevent hanging).
+            # wait_for on a plain future doesn't wrap it in a Task, and it
+            # measured faster than "async with asyncio.timeout()" on uvloop
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            # Forget the call if it timed out or failed to send
+            self._pending.pop(request_id, None)
+
+    async def call_batch(self, calls: List[Tuple[str, Dict[str, Any]]], timeout: float = 5.0) -> List[Dict[str, Any]]:
+        """
+        Make several remote procedure calls in a single message.
+        
+        The requests are sent together as one array and the server answers
+        with one array of responses, saving a frame and a round of
+        encoding/decoding per call.
+        
+        Args:
+            calls: (action, params) pairs, e.g. [("add_numbers", {"a": 1, "b": 2})]
+            timeout: Maximum time to wait for all responses (in seconds)
+            
+        Returns:
+            The server's responses, in the same order as the calls
+            
+        Raises:
+            ValueError: If no calls are given
+            RuntimeError: If the client is not connected
+            ConnectionError: If the connection closes before the responses arrive
+            asyncio.TimeoutError: If the server doesn't respond in time
+        """
+        if not calls:
+            raise ValueError("A batch needs at least one call")
+        if self._ws is None:
+            raise RuntimeError("Client is not connected")
+
+        # Every call in the batch gets its own ID so responses can be matched
+        payloads = [
+            {"request_id": next(self._next_id), "action": action, "params": params}
+            for action, params in calls
+        ]
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for payload in payloads:
+            future = loop.create_future()
+            self._pending[payload["request_id"]] = future
+            futures.append(future)
+        try:
+            # Send the whole batch as one frame
+            await self._ws.send(self._codec.dumps(payloads))
+
+            # gather keeps the futures in call order, whatever order the server replies in
+            return await asyncio.wait_for(asyncio.gather(*futures), timeout=timeout)
+        finally:
+            for payload in payloads:
+                self._pending.pop(payload["request_id"], None)
+
+
 async def call_action(action: str, params: Dict[str, Any], timeout: float = 5.0) -> Dict[str, Any]:
     """
-    Make a remote procedure call to the server.
+    Make a single remote procedure call over a short-lived connection.
     
-    This function handles the complete request-response cycle:
-    1. Creates a unique request ID
-    2. Sends the request to the server
-    3. Waits for and validates the response
-    4. Returns the server's response
+    Convenient for one-off calls; use RPCClient directly to make several
+    calls over one connection.
     
     Args:
         action: The name of the function to call (e.g., "add_numbers")
@@ -36,40 +247,9 @@ async def call_action(action: str, params: Dict[str, Any], timeout: float = 5.0)
         
     Returns:
         The server's response as a dictionary
-        
-    Raises:
-        RuntimeError: If the response doesn't match the request
-        asyncio.TimeoutError: If the server doesn't respond in time
     """
-    # Generate a unique ID for this request - this is crucial for matching responses
-    # If multiple calls are made simultaneously, each needs its own ID
-    request_id = str(uuid.uuid4())
-    
-    # Create the request message following our protocol
-    payload = {
-        "request_id": request_id,  # So the server knows which request this is
-        "action": action,          # Which function to call
-        "params": params,          # The arguments to pass
-    }
-
-    # Connect to the server, send the request, and wait for the response
-    # The 'async with' ensures the connection is properly closed
-    async with websockets.connect(SERVER_URL) as ws:
-        # Send the request to the server
-        await ws.send(json.dumps(payload))
-        
-        # Wait for the response (with a timeout to prevent hanging)
-        raw = await asyncio.wait_for(ws.recv(), timeout=timeout)
-        
-        # Parse the response
-        response = json.loads(raw)
-
-        # Verify that the response is for our request
-        # This is critical when making multiple concurrent calls
-        if response.get("request_id") != request_id:
-            raise RuntimeError("Unexpected response ID")
-
-        return response
+    async with RPCClient() as client:
+        return await client.call_action(action, params, timeout=timeout)
 
 
 async def main():
@@ -79,17 +259,27 @@ async def main():
     This shows that the client works correctly by making multiple calls
     with different parameters and printing the results.
     """
-    # Make several calls to demonstrate the system works
-    print("Calling add_numbers(10, 20):")
-    print(await call_action("add_numbers", {"a": 10, "b": 20}))
-    
-    print("\nCalling multiply_numbers(3, 7):")
-    print(await call_action("multiply_numbers", {"a": 3, "b": 7}))
-    
-    print("\nCalling echo('hello'):")
-    print(await call_action("echo", {"message": "hello"}))
+    # Make several calls over a single connection to demonstrate the system works
+    async with RPCClient() as client:
+        print("Calling add_numbers(10, 20):")
+        print(await client.call_action("add_numbers", {"a": 10, "b": 20}))
+        
+        print("\nCalling multiply_numbers(3, 7):")
+        print(await client.call_action("multiply_numbers", {"a": 3, "b": 7}))
+        
+        print("\nCalling echo('hello'):")
+        print(await client.call_action("echo", {"message": "hello"}))
+
+        print("\nCalling add_numbers(1, 2) and echo('batch') in one batch:")
+        for response in await client.call_batch([
+            ("add_numbers", {"a": 1, "b": 2}),
+            ("echo", {"message": "batch"}),
+        ]):
+            print(response)
 
 
 if __name__ == "__main__":
-    # Run the demonstration when the script is executed directly
-    asyncio.run(main())
\ No newline at end of file
+    # Run the demonstration when the script is executed directly,
+    # on uvloop when it is installed and the default asyncio loop otherwise
+    run = uvloop.run if uvloop is not None else asyncio.run
+    run(main())
\ No newline at end of file
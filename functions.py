@@ -4,19 +4,20 @@ RPC Function Registry
 Contains the actual functions that clients can call remotely.
 """
 
-from typing import Callable, Dict
+import asyncio
+import inspect
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
 
 
 def add_numbers(a: float, b: float) -> float:
     """
     Add two numbers together.
     
+    The server checks that both arguments are numbers before calling this.
+    
     Raises:
-        TypeError: If either argument is not a number
+        TypeError: If the arguments can't be added together
     """
-    # Validate input types to prevent runtime errors
-    if not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
-        raise TypeError("'a' and 'b' must be numbers")
     return a + b
 
 
@@ -24,12 +25,11 @@ def multiply_numbers(a: float, b: float) -> float:
     """
     Multiply two numbers together.
     
+    The server checks that both arguments are numbers before calling this.
+    
     Raises:
-        TypeError: If either argument is not a number
+        TypeError: If the arguments can't be multiplied together
     """
-    # Validate input types to prevent runtime errors
-    if not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
-        raise TypeError("'a' and 'b' must be numbers")
     return a * b
 
 
@@ -37,20 +37,137 @@ def echo(message: str) -> str:
     """
     Return the same message that was sent.
     
-    Raises:
-        TypeError: If the message is not a string
+    The server checks that the message is a string before calling this.
     """
-    # Validate input type to prevent runtime errors
-    if not isinstance(message, str):
-        raise TypeError("'message' must be a string")
     return message
 
+
+def _expect(message: str, /, **types: Tuple[type, ...]) -> Callable[[Dict[str, Any]], None]:
+    """
+    Build a validator that checks the types of an action's parameters.
+    
+    Args:
+        message: The error message to use when a parameter has the wrong type
+        **types: The accepted type(s) for each parameter, by name
+        
+    Returns:
+        A function that raises TypeError if the params don't match
+    """
+    # Resolve the checks once, so validating a request is just a short loop
+    checks = tuple(types.items())
+
+    def validate(params: Dict[str, Any]) -> None:
+        for name, expected in checks:
+            if not isinstance(params.get(name), expected):
+                raise TypeError(message)
+
+    return validate
+
+
+def _check_params(params: Dict[str, Any], param_names: Tuple[str, ...]) -> None:
+    """
+    Explain why params don't match a function's parameters.
+    
+    Only called once a mismatch has been detected, so it can take its time.
+    
+    Raises:
+        TypeError: Naming the first missing or the unexpected parameter(s)
+    """
+    for name in param_names:
+        if name not in params:
+            raise TypeError(f"Missing parameter '{name}'")
+    unexpected = ", ".join(f"'{name}'" for name in params if name not in param_names)
+    raise TypeError(f"Unexpected parameter(s) {unexpected}")
+
+
+def _compile_invoker(func: Callable[..., Any], param_names: Tuple[str, ...],
+                     validate: Optional[Callable[[Dict[str, Any]], None]]) -> Callable[[Dict[str, Any]], Any]:
+    """
+    Generate a function that calls func with arguments taken from a params dict.
+    
+    For add_numbers(a, b) the generated source is:
+    
+        def invoke(params):
+            if len(params) != 2 or 'a' not in params or 'b' not in params:
+                check_params(params, param_names)
+            validate(params)
+            return func(params['a'], params['b'])
+    
+    Spelling the parameters out avoids a generic loop over param_names and
+    the argument list it would build on every request.
+    """
+    check = " or ".join([f"len(params) != {len(param_names)}"] + [f"{name!r} not in params" for name in param_names])
+    args = ", ".join(f"params[{name!r}]" for name in param_names)
+    lines = [
+        "def invoke(params):",
+        f"    if {check}:",
+        "        check_params(params, param_names)",
+    ]
+    if validate is not None:
+        lines.append("    validate(params)")
+    lines.append(f"    return func({args})")
+
+    namespace = {"func": func, "validate": validate, "param_names": param_names, "check_params": _check_params}
+    exec(compile("\n".join(lines), f"<invoke {func.__qualname__}>", "exec"), namespace)
+    return namespace["invoke"]
+
+
+class Action(NamedTuple):
+    """
+    A registered RPC function, prepared for fast dispatch.
+    
+    Args:
+        func: The function to call
+        is_coroutine: Whether the function is async and must be awaited
+        param_names: The function's parameter names, in positional order
+        validate: Checks the request params before the call (or None to skip)
+        invoke: Checks the request params and calls the function with them;
+            raises TypeError for missing, unexpected or invalid params
+    """
+    func: Callable[..., Any]
+    is_coroutine: bool
+    param_names: Tuple[str, ...]
+    validate: Optional[Callable[[Dict[str, Any]], None]]
+    invoke: Callable[[Dict[str, Any]], Any]
+
+
+def register(name: str, func: Callable[..., Any],
+             validate: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+    """
+    Add a function to the registry under the given action name.
+    
+    Everything the server needs to know about the function is worked out
+    here, once, instead of on every request. The server passes the request
+    params to the function positionally, so every parameter must be a
+    required positional one.
+    
+    Raises:
+        ValueError: If the function has parameters the server can't fill
+    """
+    param_names = []
+    for param in inspect.signature(func).parameters.values():
+        if param.kind not in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD) or param.default is not param.empty:
+            raise ValueError(f"Parameter '{param.name}' of '{name}' must be a required positional parameter")
+        param_names.append(param.name)
+
+    param_names = tuple(param_names)
+    FUNCTION_REGISTRY[name] = Action(
+        func,
+        asyncio.iscoroutinefunction(func),
+        param_names,
+        validate,
+        _compile_invoker(func, param_names, validate),
+    )
+
+
+_NUMBER = (int, float)
+
 # This makes it easy to add new functions without changing server code
-FUNCTION_REGISTRY: Dict[str, Callable] = {
-    "add_numbers": add_numbers,
-    "multiply_numbers": multiply_numbers,
-    "echo": echo,
-}
+FUNCTION_REGISTRY: Dict[str, Action] = {}
+
+register("add_numbers", add_numbers, _expect("'a' and 'b' must be numbers", a=_NUMBER, b=_NUMBER))
+register("multiply_numbers", multiply_numbers, _expect("'a' and 'b' must be numbers", a=_NUMBER, b=_NUMBER))
+register("echo", echo, _expect("'message' must be a string", message=(str,)))
 
 # Example of how to add a new function:
 # 
@@ -58,4 +175,4 @@ FUNCTION_REGISTRY: Dict[str, Callable] = {
 #     return f"Number is: {x}"
 # 
 # Then add it to the registry:
-# FUNCTION_REGISTRY["new_function"] = new_function
\ No newline at end of file
+# register("new_function", new_function, _expect("'x' must be an integer", x=(int,)))
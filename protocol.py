@@ -2,11 +2,28 @@
 RPC Protocol Definition
 =======================
 Defines the message format and parsing/validation rules for our WebSocket RPC system.
+
+Messages can be encoded as JSON (the default) or MessagePack. The wire
+format is chosen per connection through the WebSocket subprotocol, which also
+says whether the client accepts replies combined into one frame.
 """
 
 import json
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+import msgpack
+import orjson
+
+# Clients may identify requests by a string (e.g. a UUID) or an integer
+RequestID = Union[str, int]
+
+# Integers on the wire must fit in 64 bits (signed, or unsigned for positive
+# values): the range both orjson and MessagePack represent exactly. orjson
+# reads JSON integers outside it as floats, as JSON parsers using doubles do
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 64 - 1
 
 
 @dataclass
@@ -15,11 +32,12 @@ class RPCError(Exception):
     Represents an error that occurs during RPC processing.
     
     Args:
-        request_id: The ID of the original request (or None if parsing failed)
+        request_id: The ID of the original request, a string or an integer
+            (or None if parsing failed)
         code: A short error code for programmatic handling
         message: A human-readable description of the error
     """
-    request_id: Optional[str]
+    request_id: Optional[RequestID]
     code: str
     message: str
 
@@ -34,46 +52,224 @@ class RPCError(Exception):
             },
         }
 
+    def to_json(self) -> bytes:
+        """
+        Serialize the error straight to JSON bytes.
+        
+        Equivalent to orjson.dumps(self.to_dict()), but the envelope is a
+        constant and the "error" object of the errors with a fixed message is
+        encoded in advance, so for those only the request ID is encoded per call.
+        """
+        request_id = b"null" if self.request_id is None else orjson.dumps(self.request_id)
+        body = _CONSTANT_ERROR_BODIES.get((self.code, self.message))
+        if body is None:
+            # The message may contain client data (e.g. the unknown action
+            # name), so it is encoded every time rather than cached
+            body = orjson.dumps({"code": self.code, "message": self.message})
+        return _ERROR_TEMPLATE % (request_id, body)
+
+
+# Error responses differ only in request_id and the error body
+_ERROR_TEMPLATE = b'{"request_id":%b,"status":"error","error":%b}'
+
+# The "error" objects of the errors whose message never varies, encoded once
+_CONSTANT_ERROR_BODIES: Dict[Tuple[str, str], bytes] = {
+    (code, message): orjson.dumps({"code": code, "message": message})
+    for code, message in (
+        ("invalid_json", "Payload is not valid JSON"),
+        ("invalid_payload", "Payload must be an object"),
+        ("invalid_payload", "Batch must not be empty"),
+        ("invalid_action", "Missing or invalid 'action'"),
+        ("invalid_params", "'params' must be a dictionary"),
+    )
+}
+
+
+class Codec(ABC):
+    """
+    A wire format for RPC messages.
+    
+    Attributes:
+        subprotocol: The WebSocket subprotocol a client asks for to use this codec
+        error_code: The error code reported for payloads that can't be decoded
+        error_message: The error message reported for payloads that can't be decoded
+        decode_errors: The exceptions loads() raises for undecodable payloads
+    """
+    subprotocol: str
+    error_code: str
+    error_message: str
+    decode_errors: Tuple[Type[Exception], ...]
+
+    @abstractmethod
+    def loads(self, raw: Union[str, bytes]) -> Any:
+        """Decode a raw message."""
+
+    @abstractmethod
+    def dumps(self, obj: Any) -> bytes:
+        """Encode a message."""
+
+    def encode_result(self, request_id: Optional[RequestID], result: Any) -> bytes:
+        """Encode a success response."""
+        return self.dumps(make_response(request_id, "ok", result))
+
+    def encode_error(self, error: RPCError) -> bytes:
+        """Encode an error response."""
+        return self.dumps(error.to_dict())
+
+    @abstractmethod
+    def join(self, items: List[bytes]) -> bytes:
+        """Combine already-encoded messages into one encoded array."""
+
+
+class JSONCodec(Codec):
+    """JSON via orjson, with template-based response encoding."""
+    subprotocol = "rpc.json"
+    error_code = "invalid_json"
+    error_message = "Payload is not valid JSON"
+    decode_errors = (orjson.JSONDecodeError, json.JSONDecodeError)
+
+    def loads(self, raw: Union[str, bytes]) -> Any:
+        return orjson.loads(raw)
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def encode_result(self, request_id: Optional[RequestID], result: Any) -> bytes:
+        return encode_result(request_id, result)
+
+    def encode_error(self, error: RPCError) -> bytes:
+        return error.to_json()
+
+    def join(self, items: List[bytes]) -> bytes:
+        return b"[" + b",".join(items) + b"]"
+
+
+class MsgPackCodec(Codec):
+    """
+    MessagePack: a compact binary format that is smaller than JSON and
+    cheaper to encode and decode for the small, mostly numeric messages
+    this protocol carries.
+    """
+    subprotocol = "rpc.msgpack"
+    error_code = "invalid_msgpack"
+    error_message = "Payload is not valid MessagePack"
+    # msgpack reports malformed input as ValueError subclasses, and
+    # TypeError when handed a text frame instead of bytes
+    decode_errors = (msgpack.UnpackException, ValueError, TypeError)
+
+    def loads(self, raw: Union[str, bytes]) -> Any:
+        return msgpack.unpackb(raw, raw=False)
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj)
+
+    def join(self, items: List[bytes]) -> bytes:
+        # A MessagePack array is a length header followed by its elements
+        return _MSGPACK_PACKER.pack_array_header(len(items)) + b"".join(items)
+
+
+_MSGPACK_PACKER = msgpack.Packer()
 
-def parse_request(raw: str) -> Dict[str, Any]:
+
+JSON = JSONCodec()
+MSGPACK = MsgPackCodec()
+
+# Appended to a codec's subprotocol by clients that accept replies to
+# separate requests combined into one array of responses
+COALESCE_SUFFIX = "+coalesce"
+
+# Supported subprotocols, in order of preference: the codec each one selects
+# and whether replies may be combined
+SUBPROTOCOLS: Dict[str, Tuple[Codec, bool]] = {
+    codec.subprotocol + suffix: (codec, suffix == COALESCE_SUFFIX)
+    for codec in (MSGPACK, JSON)
+    for suffix in (COALESCE_SUFFIX, "")
+}
+
+
+def parse_request(raw: Union[str, bytes], codec: Codec = JSON) -> Union[Dict[str, Any], List[Union[Dict[str, Any], RPCError]]]:
     """
-    Convert a raw JSON string into a structured request dictionary.
+    Convert a raw message into a structured request dictionary.
+    
+    A message may also be a batch: an array of request objects sent in
+    a single frame. Each entry of a batch is validated on its own, so one bad
+    entry doesn't reject the whole batch.
     
     Args:
-        raw: The raw JSON string received from the client
+        raw: The raw message received from the client (text or binary frame)
+        codec: The wire format of the message (JSON unless negotiated otherwise)
         
     Returns:
-        A dictionary with the parsed request data
+        A dictionary with the parsed request data, or for a batch a list with
+        one item per entry: the parsed request, or the RPCError describing why
+        that entry is invalid
         
     Raises:
         RPCError: If the message is invalid in any way
     """
-    # First, try to parse the JSON
+    # First, try to decode the message
     try:
-        payload = json.loads(raw)
-    except json.JSONDecodeError:
-        # If it's not valid JSON, we can't even determine the request_id
+        payload = codec.loads(raw)
+    except codec.decode_errors:
+        # If it can't be decoded, we can't even determine the request_id
         raise RPCError(
             request_id=None,
-            code="invalid_json",
-            message="Payload is not valid JSON"
+            code=codec.error_code,
+            message=codec.error_message
         )
 
-    # The message must be a JSON object (dictionary), not a string or array
-    if not isinstance(payload, dict):
-        raise RPCError(None, "invalid_payload", "Payload must be a JSON object")
+    # A single request object is by far the most common message
+    if type(payload) is dict:
+        return _validate_request(payload)
+
+    # An array is a batch of requests
+    if type(payload) is list:
+        if not payload:
+            raise RPCError(None, "invalid_payload", "Batch must not be empty")
+
+        batch: List[Union[Dict[str, Any], RPCError]] = []
+        for entry in payload:
+            try:
+                batch.append(_validate_request(entry))
+            except RPCError as e:
+                batch.append(e)
+        return batch
+
+    return _validate_request(payload)
+
+
+def _validate_request(payload: Any) -> Dict[str, Any]:
+    """
+    Check that a decoded message has the shape of a request.
+    
+    Args:
+        payload: A single decoded JSON value
+        
+    Returns:
+        A dictionary with the parsed request data
+        
+    Raises:
+        RPCError: If the request is invalid in any way
+    """
+    # The decoders only ever produce plain dicts, lists and strs, so exact
+    # type checks are equivalent to isinstance here and cheaper on the hot path
+
+    # The request must be an object (dictionary), not a string or number
+    if type(payload) is not dict:
+        raise RPCError(None, "invalid_payload", "Payload must be an object")
 
-    # Extract the request ID (used to match responses to requests)
+    # Extract the request ID (used to match responses to requests);
+    # it is echoed back as-is, so strings and integers both work
     request_id = payload.get("request_id")
 
     # Every request must have an action (which function to call)
     action = payload.get("action")
-    if not action or not isinstance(action, str):
+    if type(action) is not str or not action:
         raise RPCError(request_id, "invalid_action", "Missing or invalid 'action'")
 
     # Parameters must be a dictionary (can be empty)
     params = payload.get("params", {})
-    if not isinstance(params, dict):
+    if type(params) is not dict:
         raise RPCError(request_id, "invalid_params", "'params' must be a dictionary")
 
     # Return the validated, structured request
@@ -84,7 +280,7 @@ def parse_request(raw: str) -> Dict[str, Any]:
     }
 
 
-def make_response(request_id: Optional[str], status: str, result: Any = None) -> Dict[str, Any]:
+def make_response(request_id: Optional[RequestID], status: str, result: Any = None) -> Dict[str, Any]:
     """
     Create a standardized response message.
     
@@ -108,4 +304,25 @@ def make_response(request_id: Optional[str], status: str, result: Any = None) ->
     else:
         base["error"] = result
 
-    return base
\ No newline at end of file
+    return base
+
+
+# Success responses differ only in request_id and result
+_RESULT_TEMPLATE = b'{"request_id":%b,"status":"ok","result":%b}'
+
+
+def encode_result(request_id: Optional[RequestID], result: Any) -> bytes:
+    """
+    Serialize a success response straight to JSON bytes.
+    
+    Equivalent to orjson.dumps(make_response(request_id, "ok", result)),
+    but skips building the intermediate response dictionary.
+    
+    Args:
+        request_id: The ID of the original request (for matching responses)
+        result: The result of the function call
+        
+    Returns:
+        The JSON-encoded response message
+    """
+    return _RESULT_TEMPLATE % (orjson.dumps(request_id), orjson.dumps(result))
@@ -4,94 +4,380 @@ WebSocket RPC Server
 A production-ready WebSocket server that allows clients to call functions remotely.
 Key features:
 - Handles multiple clients simultaneously
+- Can run several worker processes on one port to use every CPU core
 - Validates input types to prevent errors
 - Provides meaningful error messages
 - Uses a registry pattern for easy function extension
 """
 
+import argparse
 import asyncio
-import json
 import logging
-from typing import Any, Callable
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import sys
+from typing import Any, Dict, List, Optional, Set, Union
 
 import websockets
 
-from protocol import parse_request, make_response, RPCError
+try:
+    # uvloop (libuv-based event loop) is only available on Linux/macOS
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from protocol import parse_request, RPCError, Codec, SUBPROTOCOLS, JSON, INT_MIN, INT_MAX
 from functions import FUNCTION_REGISTRY
 
 # Set up logging (connection/disconnection, errors)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# How many requests from one connection may be in progress at the same time.
+# Each entry of a batch counts as a request, so a batch may hold at most
+# this many entries
+MAX_IN_FLIGHT = 64
+
+# Largest incoming message accepted, in bytes. Bigger frames are rejected
+# (the connection is closed with code 1009) before any of it is decoded
+MAX_MESSAGE_SIZE = 2 ** 20
+
+# A parsed message: a request, a batch (requests and per-entry errors), or
+# the error to answer an invalid message with
+Message = Union[Dict[str, Any], List[Union[Dict[str, Any], RPCError]], RPCError]
+
+
+async def dispatch(request: Dict[str, Any]) -> Any:
+    """
+    Execute a single parsed request.
+    
+    Args:
+        request: A request dictionary as returned by parse_request
+        
+    Returns:
+        The result of the function call
+        
+    Raises:
+        RPCError: If the action is unknown or the function call fails
+    """
+    # Extract the essential parts of the request
+    request_id = request["request_id"]  # Unique ID for this request
+    action = request["action"]          # The function to call
+    params = request.get("params", {})  # Parameters for the function call
+
+    # Look up the function in our registry
+    entry = FUNCTION_REGISTRY.get(action)
+    
+    # If the function doesn't exist, respond with an error
+    if entry is None:
+        raise RPCError(
+            request_id=request_id,
+            code="unknown_action",
+            message=f"Unknown action '{action}'"
+        )
+
+    try:
+        # Check the params and call the function with them - handle both
+        # sync and async functions
+        if entry.is_coroutine:
+            # If it's an async function, await it
+            return await entry.invoke(params)
+        else:
+            # If it's a regular function, call it directly
+            return entry.invoke(params)
+
+    except TypeError as e:
+        # If the function was called with missing, unexpected or wrongly typed parameters
+        raise RPCError(request_id=request_id, code="invalid_params", message=str(e))
+
+    except Exception as e:
+        # For any other unexpected errors, log them and send a server error
+        logging.exception("Unhandled error while executing '%s'", action)
+        raise RPCError(request_id=request_id, code="server_error", message=str(e))
+
+
+def encode_error(error: RPCError, codec: Codec) -> bytes:
+    """
+    Encode an error response.
+    
+    If the error itself can't be encoded (e.g. its request_id can't be),
+    the client gets a server_error without a request_id instead.
+    
+    Args:
+        error: The error to report
+        codec: The wire format negotiated for the connection
+        
+    Returns:
+        The encoded response
+    """
+    try:
+        return codec.encode_error(error)
+    except Exception:
+        logging.exception("Could not encode error response %r", error)
+        return codec.encode_error(RPCError(request_id=None, code="server_error", message="Response could not be encoded"))
+
+
+def encode_reply(request_id: Any, result: Any, codec: Codec) -> bytes:
+    """
+    Encode the success response to a request.
+    
+    An integer result outside the 64-bit range the protocol supports (see
+    protocol.INT_MIN/INT_MAX) is answered with an invalid_params error. A
+    non-finite float (which JSON can't represent) and any other result the
+    codec can't encode are answered with a server_error, so the client
+    still gets a response.
+    
+    Args:
+        request_id: The ID of the original request
+        result: The result of the function call
+        codec: The wire format negotiated for the connection
+        
+    Returns:
+        The encoded response
+    """
+    if type(result) is int and not INT_MIN <= result <= INT_MAX:
+        error = RPCError(request_id=request_id, code="invalid_params", message="Result does not fit in a 64-bit integer")
+        return encode_error(error, codec)
+    if type(result) is float and not math.isfinite(result):
+        error = RPCError(request_id=request_id, code="server_error", message="Result is not a finite number")
+        return encode_error(error, codec)
+    try:
+        return codec.encode_result(request_id, result)
+    except Exception as e:
+        logging.exception("Could not encode the result of request %r", request_id)
+        error = RPCError(request_id=request_id, code="server_error", message=f"Result could not be encoded: {e}")
+        return encode_error(error, codec)
+
+
+async def dispatch_batch(batch: List[Union[Dict[str, Any], RPCError]], codec: Codec) -> List[bytes]:
+    """
+    Execute every request of a batch concurrently.
+    
+    Args:
+        batch: A batch as returned by parse_request (requests and per-entry errors)
+        codec: The wire format negotiated for the connection
+        
+    Returns:
+        One encoded response per batch entry, in the same order as the batch
+    """
+    async def respond(entry: Union[Dict[str, Any], RPCError]) -> bytes:
+        # Entries that failed validation already carry their error
+        if isinstance(entry, RPCError):
+            return encode_error(entry, codec)
+        try:
+            result = await dispatch(entry)
+        except RPCError as e:
+            return encode_error(e, codec)
+        return encode_reply(entry["request_id"], result, codec)
+
+    return await asyncio.gather(*(respond(entry) for entry in batch))
+
+
+def parse_message(raw: Union[str, bytes], codec: Codec) -> Message:
+    """
+    Parse one incoming message.
+    
+    Args:
+        raw: The raw message received from the client
+        codec: The wire format negotiated for the connection
+        
+    Returns:
+        The request or batch as returned by parse_request, or the RPCError
+        to answer with if the message is invalid or the batch is larger than
+        MAX_IN_FLIGHT
+    """
+    try:
+        message = parse_request(raw, codec)
+    except RPCError as e:
+        return e
+    if isinstance(message, list) and len(message) > MAX_IN_FLIGHT:
+        return RPCError(None, "invalid_payload", f"Batch must not have more than {MAX_IN_FLIGHT} entries")
+    return message
+
+
+async def handle_request(message: Message, codec: Codec) -> Union[bytes, List[bytes]]:
+    """
+    Execute a parsed message and encode the reply.
+    
+    Args:
+        message: A message as returned by parse_message
+        codec: The wire format negotiated for the connection
+        
+    Returns:
+        The encoded response, or for a batch the list of encoded responses
+        (see coalesce)
+    """
+    # If the message is malformed, answer with an error
+    if isinstance(message, RPCError):
+        return encode_error(message, codec)
+
+    if isinstance(message, list):
+        return await dispatch_batch(message, codec)
+
+    try:
+        result = await dispatch(message)
+    except RPCError as e:
+        return encode_error(e, codec)
+    # Send the successful result back to the client
+    return encode_reply(message["request_id"], result, codec)
+
+
+async def handle_message(raw: Union[str, bytes], codec: Codec) -> Union[bytes, List[bytes]]:
+    """
+    Process one incoming message and encode the reply.
+    
+    Args:
+        raw: The raw message received from the client
+        codec: The wire format negotiated for the connection
+        
+    Returns:
+        The encoded response, or for a batch the list of encoded responses
+        (see coalesce)
+    """
+    return await handle_request(parse_message(raw, codec), codec)
+
+
+def coalesce(replies: List[Union[bytes, List[bytes]]], codec: Codec) -> bytes:
+    """
+    Combine replies that are ready at the same time into a single frame.
+    
+    A lone reply to a single request goes out as it is. Anything else -
+    a batch, or several replies at once - is sent as one array of
+    responses, the same shape as a batch response. Only clients that
+    negotiated a coalescing subprotocol get several replies at once; for
+    everyone else each reply is passed on its own.
+    
+    Args:
+        replies: Replies as returned by handle_message
+        codec: The wire format negotiated for the connection
+        
+    Returns:
+        The encoded frame
+    """
+    if len(replies) == 1 and type(replies[0]) is bytes:
+        return replies[0]
+
+    items: List[bytes] = []
+    for reply in replies:
+        if type(reply) is bytes:
+            items.append(reply)
+        else:
+            items.extend(reply)
+    return codec.join(items)
+
 
 async def handle_connection(ws: websockets.WebSocketServerProtocol) -> None:
     """
     Handle a single client connection throughout its lifetime.
     
     This function runs for each connected client until they disconnect.
-    It listens for incoming messages and processes them one by one.
+    Every incoming message is handled in its own task, so a slow call
+    doesn't hold up the messages behind it; responses are sent as soon as
+    they are ready and may arrive out of order (clients match them by
+    request_id). At most MAX_IN_FLIGHT requests per connection are in
+    progress (handled but not yet sent) at once, each entry of a batch
+    counting as one request, after which reading pauses until enough of
+    them finish.
+    
+    All responses go out through one writer task. If the client negotiated
+    a coalescing subprotocol, responses that are ready at the same time are
+    sent together as one array of responses (see coalesce), saving a frame
+    and a write per extra response. Otherwise they are sent back to back,
+    one frame each.
+    
+    A batch message (array of requests) is answered with a single
+    array of responses.
+    
+    Messages are JSON unless the client negotiated another codec through
+    the WebSocket subprotocol (see protocol.SUBPROTOCOLS).
     
     Args:
         ws: The WebSocket connection to the client
     """
     # Get the client's IP address for logging purposes
     peer = ws.remote_address
-    logging.info("Client connected: %s", peer)
+    codec, coalescing = SUBPROTOCOLS.get(ws.subprotocol, (JSON, False))
+    logging.info("Client connected: %s (%s)", peer, ws.subprotocol or JSON.subprotocol)
+
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    # Encoded replies waiting for the writer
+    outbox: asyncio.Queue = asyncio.Queue()
+    # Strong references to the running tasks, so they aren't garbage collected
+    tasks: Set[asyncio.Task] = set()
+
+    def slots(item: Any) -> int:
+        # A message or reply takes one slot per request: a batch one per entry
+        return len(item) if type(item) is list else 1
+
+    async def reply(message: Message) -> None:
+        try:
+            outbox.put_nowait(await handle_request(message, codec))
+        except Exception:
+            logging.exception("Unexpected error while answering client %s", peer)
+            for _ in range(slots(message)):
+                in_flight.release()
+
+    async def write_replies() -> None:
+        try:
+            while True:
+                # Wait for a reply, then take every other reply that's ready too
+                replies = [await outbox.get()]
+                while not outbox.empty():
+                    replies.append(outbox.get_nowait())
+                try:
+                    if coalescing:
+                        await ws.send(coalesce(replies, codec))
+                    else:
+                        # Clients that didn't opt in expect one frame per reply
+                        for ready in replies:
+                            await ws.send(coalesce([ready], codec))
+                finally:
+                    for _ in range(sum(map(slots, replies))):
+                        in_flight.release()
+        except websockets.ConnectionClosed:
+            # The client is gone; there's nobody left to answer
+            pass
+
+    # Resolves when the connection closes, to stop waiting for slots
+    closed = asyncio.ensure_future(ws.wait_closed())
+
+    async def take_slots(count: int) -> bool:
+        # Wait for count free slots; False if the client went away meanwhile,
+        # since the requests holding the slots may never finish on their own.
+        # Only the reading loop takes slots, so waiting for several can't deadlock
+        for _ in range(count):
+            if not in_flight.locked():
+                await in_flight.acquire()
+                continue
+            slot = asyncio.ensure_future(in_flight.acquire())
+            await asyncio.wait((slot, closed), return_when=asyncio.FIRST_COMPLETED)
+            if not slot.done():
+                slot.cancel()
+                return False
+        return True
+
+    writer = asyncio.create_task(write_replies())
     
     try:
         # Keep listening for messages from this client until they disconnect
+        # Binary frames arrive as bytes and skip the UTF-8 validation that
+        # websockets applies to text frames; the decoders check the encoding
+        # while parsing anyway. Text frames are still accepted for JSON.
         async for raw in ws:
             # Log the raw message for debugging
             logging.debug("Raw message from %s: %s", peer, raw)
-            
-            # Parse the incoming message and handle parsing errors gracefully
-            try:
-                request = parse_request(raw)
-            except RPCError as e:
-                # If the message is malformed, send an error response and continue
-                await ws.send(json.dumps(e.to_dict()))
-                continue
-
-            # Extract the essential parts of the request
-            request_id = request["request_id"]  # Unique ID for this request
-            action = request["action"]          # The function to call
-            params = request.get("params", {})  # Parameters for the function call
-
-            # Look up the function in our registry
-            func: Callable[..., Any] = FUNCTION_REGISTRY.get(action)
-            
-            # If the function doesn't exist, send an error response
-            if func is None:
-                err = RPCError(
-                    request_id=request_id,
-                    code="unknown_action",
-                    message=f"Unknown action '{action}'"
-                )
-                await ws.send(json.dumps(err.to_dict()))
-                continue
 
-            try:
-                # Execute the function - handle both sync and async functions
-                if asyncio.iscoroutinefunction(func):
-                    # If it's an async function, await it
-                    result = await func(**params)
-                else:
-                    # If it's a regular function, call it directly
-                    result = func(**params)
-
-                # Send the successful result back to the client
-                resp = make_response(request_id=request_id, status="ok", result=result)
-                await ws.send(json.dumps(resp))
-
-            except TypeError as e:
-                # If the function was called with wrong parameter types
-                err = RPCError(request_id=request_id, code="invalid_params", message=str(e))
-                await ws.send(json.dumps(err.to_dict()))
-
-            except Exception as e:
-                # For any other unexpected errors, log them and send a server error
-                logging.exception("Unhandled error while executing '%s'", action)
-                err = RPCError(request_id=request_id, code="server_error", message=str(e))
-                await ws.send(json.dumps(err.to_dict()))
+            # Wait for a free slot per request, then handle the message in
+            # the background
+            message = parse_message(raw, codec)
+            if not await take_slots(slots(message)):
+                logging.info("Client disconnected: %s", peer)
+                break
+            task = asyncio.create_task(reply(message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
     except websockets.ConnectionClosed:
         # The client disconnected normally
@@ -99,27 +385,159 @@ async def handle_connection(ws: websockets.WebSocketServerProtocol) -> None:
     except Exception:
         # Something unexpected happened at the connection level
         logging.exception("Unexpected connection-level error for client %s", peer)
+    finally:
+        # Requests still running can't be answered on a closed connection
+        for task in tasks:
+            task.cancel()
+        writer.cancel()
+        closed.cancel()
 
 
-async def main(host: str = "localhost", port: int = 8000):
+async def main(host: str = "localhost", port: int = 8000, reuse_port: bool = False,
+               max_size: int = MAX_MESSAGE_SIZE):
     """
     Start the WebSocket server and keep it running indefinitely.
     
     Args:
         host: The hostname to bind to (usually localhost for development)
         port: The port number to listen on
+        reuse_port: Let several processes listen on the same port (SO_REUSEPORT)
+        max_size: The largest incoming message accepted, in bytes
     """
     logging.info("Starting RPC WebSocket server on ws://%s:%d", host, port)
-    # Create the WebSocket server and keep it running forever
-    async with websockets.serve(handle_connection, host, port):
+    # Create the WebSocket server and keep it running forever.
+    # RPC messages are tiny, so permessage-deflate would only add a zlib
+    # context per connection and a compress/decompress pass per frame.
+    # Without it one connection measured ~1.6x the requests per second
+    # one at a time and ~2.3x with 32 requests in flight
+    async with websockets.serve(handle_connection, host, port, reuse_port=reuse_port,
+                                compression=None, subprotocols=list(SUBPROTOCOLS), max_size=max_size):
         # This line keeps the server running - it never completes
         await asyncio.Future()
 
 
-if __name__ == "__main__":
+def run_server(host: str = "localhost", port: int = 8000, reuse_port: bool = False,
+               cpu: Optional[int] = None, max_size: int = MAX_MESSAGE_SIZE) -> None:
+    """
+    Run the server in the current process until interrupted.
+    
+    Uses uvloop when it is installed and the default asyncio loop otherwise.
+    
+    Args:
+        host: The hostname to bind to
+        port: The port number to listen on
+        reuse_port: Let several processes listen on the same port (SO_REUSEPORT)
+        cpu: Pin this process to the given CPU core (Linux only), or None
+        max_size: The largest incoming message accepted, in bytes
+    """
+    if cpu is not None:
+        # Keeping the process on one core keeps its caches warm and avoids
+        # the scheduler migrating the event loop between cores
+        os.sched_setaffinity(0, {cpu})
+        logging.info("Pinned server process %d to CPU %d", os.getpid(), cpu)
+
     try:
-        # Start the server when the script is run directly
-        asyncio.run(main())
+        run = uvloop.run if uvloop is not None else asyncio.run
+        run(main(host, port, reuse_port, max_size))
     except KeyboardInterrupt:
         # Handle Ctrl+C
-        logging.info("Server shutting down.")
\ No newline at end of file
+        logging.info("Server shutting down.")
+
+
+def assign_cpus(count: int) -> List[int]:
+    """
+    Pick a CPU core for each of count processes.
+    
+    Goes round-robin over the cores this process may run on, so the
+    processes share cores only when there are more of them than cores.
+    
+    Args:
+        count: The number of processes to pin
+        
+    Returns:
+        One CPU core number per process
+        
+    Raises:
+        RuntimeError: If CPU pinning isn't supported on this platform (Linux only)
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        raise RuntimeError("CPU pinning is only supported on Linux")
+    available = sorted(os.sched_getaffinity(0))
+    return [available[i % len(available)] for i in range(count)]
+
+
+def run_workers(workers: int, host: str = "localhost", port: int = 8000, pin_cpus: bool = False,
+                max_size: int = MAX_MESSAGE_SIZE) -> int:
+    """
+    Run the server in several processes that share one listening port.
+    
+    A single Python process can only use one CPU core for request handling
+    (the GIL). With SO_REUSEPORT every worker binds the same port and, on
+    Linux, the kernel spreads incoming connections across them, so
+    throughput scales with cores. Each connection stays with the worker
+    that accepted it. (Other platforms accept the option but don't balance
+    connections between the listeners.)
+    
+    Args:
+        workers: The number of worker processes to start
+        host: The hostname to bind to
+        port: The port number to listen on
+        pin_cpus: Pin each worker to its own CPU core, round-robin over the
+            cores this process may run on (Linux only)
+        max_size: The largest incoming message accepted, in bytes
+        
+    Returns:
+        The exit status: 0 if every worker shut down cleanly, 1 if any failed
+        
+    Raises:
+        RuntimeError: If the platform doesn't support SO_REUSEPORT (e.g. Windows)
+            or CPU pinning was requested where it isn't supported
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("Multiple workers need SO_REUSEPORT, which this platform doesn't support")
+
+    cpus: List[Optional[int]] = list(assign_cpus(workers)) if pin_cpus else [None] * workers
+
+    processes = [
+        multiprocessing.Process(target=run_server, args=(host, port, True, cpus[i], max_size), name=f"rpc-worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    # Report each worker as soon as it exits, e.g. because the port is in use
+    running = {process.sentinel: process for process in processes}
+    failed = False
+    try:
+        while running:
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                process = running.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    failed = True
+                    logging.error("Worker %s exited with code %s", process.name, process.exitcode)
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the workers too; wait for them to shut down
+        for process in running.values():
+            process.join()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebSocket RPC server")
+    parser.add_argument("--host", default="localhost", help="hostname to bind to")
+    parser.add_argument("--port", type=int, default=8000, help="port number to listen on")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes sharing the port (Linux only)")
+    parser.add_argument("--pin-cpus", action="store_true",
+                        help="pin each server process to its own CPU core (Linux only)")
+    parser.add_argument("--max-size", type=int, default=MAX_MESSAGE_SIZE,
+                        help="largest incoming message accepted, in bytes (default: %(default)s)")
+    args = parser.parse_args()
+
+    # Start the server when the script is run directly
+    if args.workers > 1:
+        sys.exit(run_workers(args.workers, args.host, args.port, pin_cpus=args.pin_cpus, max_size=args.max_size))
+    else:
+        cpu = assign_cpus(1)[0] if args.pin_cpus else None
+        run_server(args.host, args.port, cpu=cpu, max_size=args.max_size)
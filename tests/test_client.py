@@ -0,0 +1,77 @@
+from client import RPCClient
+from protocol import JSON
+import asyncio
+import contextlib
+import websockets
+import pytest
+
+
+@contextlib.asynccontextmanager
+async def client_for(handler):
+    """Serve handler on a free port and connect a JSON RPCClient to it."""
+    async with websockets.serve(handler, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        async with RPCClient(f"ws://localhost:{port}", use_msgpack=False) as client:
+            yield client
+
+
+def ok(request, result):
+    return JSON.dumps({"request_id": request["request_id"], "status": "ok", "result": result})
+
+
+def test_responses_matched_by_id():
+    async def handler(ws):
+        first, second = [JSON.loads(await ws.recv()) for _ in range(2)]
+        # Answer out of order, the second one together with a stray response
+        await ws.send(JSON.join([ok(second, "second"), JSON.dumps({"request_id": 99})]))
+        await ws.send(ok(first, "first"))
+        await ws.wait_closed()
+
+    async def main():
+        async with client_for(handler) as client:
+            return await asyncio.gather(client.call_action("a", {}), client.call_action("b", {}))
+
+    first, second = asyncio.run(main())
+    assert first["result"] == "first"
+    assert second["result"] == "second"
+
+
+def test_timeout_forgets_call():
+    async def handler(ws):
+        await ws.wait_closed()
+
+    async def main():
+        async with client_for(handler) as client:
+            with pytest.raises(asyncio.TimeoutError):
+                await client.call_action("a", {}, timeout=0.05)
+            assert not client._pending
+
+    asyncio.run(main())
+
+
+def test_connection_closed():
+    async def handler(ws):
+        await ws.recv()
+        await ws.close()
+
+    async def main():
+        async with client_for(handler) as client:
+            with pytest.raises(ConnectionError):
+                await client.call_action("a", {})
+
+    asyncio.run(main())
+
+
+def test_malformed_frames_skipped():
+    async def handler(ws):
+        async for raw in ws:
+            request = JSON.loads(raw)
+            await ws.send(b"not json")
+            # Bad items don't cost the responses after them in the same frame
+            await ws.send(JSON.join([b"5", b'{"request_id": [1]}', ok(request, "fine")]))
+
+    async def main():
+        async with client_for(handler) as client:
+            return [await client.call_action("a", {}, timeout=1) for _ in range(2)]
+
+    assert [response["result"] for response in asyncio.run(main())] == ["fine", "fine"]
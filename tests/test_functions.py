@@ -1,4 +1,4 @@
-from functions import add_numbers, multiply_numbers, echo
+from functions import add_numbers, multiply_numbers, echo, FUNCTION_REGISTRY
 import pytest
 
 def test_add_numbers():
@@ -16,4 +16,27 @@ def test_echo():
 
 def test_invalid_params():
     with pytest.raises(TypeError):
-        add_numbers("x", "y")
+        add_numbers("x", 1)
+    with pytest.raises(TypeError):
+        multiply_numbers(None, 2)
+
+
+def test_registry_validators():
+    entry = FUNCTION_REGISTRY["add_numbers"]
+    assert entry.func is add_numbers
+    assert not entry.is_coroutine
+    assert entry.param_names == ("a", "b")
+    entry.validate({"a": 1, "b": 2.5})
+    with pytest.raises(TypeError):
+        entry.validate({"a": "x", "b": 2})
+
+
+def test_registry_invoke():
+    invoke = FUNCTION_REGISTRY["add_numbers"].invoke
+    assert invoke({"a": 1, "b": 2}) == 3
+    with pytest.raises(TypeError, match="Missing parameter 'b'"):
+        invoke({"a": 1})
+    with pytest.raises(TypeError, match="Unexpected parameter"):
+        invoke({"a": 1, "b": 2, "c": 3})
+    with pytest.raises(TypeError, match="must be numbers"):
+        invoke({"a": "x", "b": 2})
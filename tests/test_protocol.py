@@ -0,0 +1,81 @@
+from protocol import parse_request, make_response, encode_result, RPCError, Codec, JSON, MSGPACK, INT_MIN, INT_MAX
+import msgpack
+import orjson
+import pytest
+
+def test_parse_request():
+    request = parse_request('{"request_id": "1", "action": "echo", "params": {"message": "hi"}}')
+    assert request == {"request_id": "1", "action": "echo", "params": {"message": "hi"}}
+
+
+def test_parse_request_invalid_json():
+    with pytest.raises(RPCError) as exc_info:
+        parse_request("not json")
+    assert exc_info.value.code == "invalid_json"
+
+
+def test_parse_batch():
+    batch = parse_request('[{"request_id": "1", "action": "echo", "params": {}}, 5]')
+    assert batch[0] == {"request_id": "1", "action": "echo", "params": {}}
+    assert isinstance(batch[1], RPCError)
+    assert batch[1].code == "invalid_payload"
+
+
+def test_parse_empty_batch():
+    with pytest.raises(RPCError) as exc_info:
+        parse_request("[]")
+    assert exc_info.value.code == "invalid_payload"
+
+
+def test_error_to_json():
+    for err in (RPCError(None, "invalid_json", "Payload is not valid JSON"),
+                RPCError(7, "invalid_action", "Missing or invalid 'action'"),
+                RPCError("abc", "unknown_action", "Unknown action 'x\"y'")):
+        assert orjson.loads(err.to_json()) == err.to_dict()
+
+
+def test_parse_request_integer_id():
+    request = parse_request(b'{"request_id": 7, "action": "echo", "params": {"message": "hi"}}')
+    assert request["request_id"] == 7
+
+
+def test_encode_result():
+    for request_id, result in ((7, 30), ("abc", "hi \"there\""), (None, [1.5, None])):
+        assert orjson.loads(encode_result(request_id, result)) == make_response(request_id, "ok", result)
+
+
+def test_parse_request_msgpack():
+    raw = msgpack.packb({"request_id": 3, "action": "echo", "params": {"message": "hi"}})
+    assert parse_request(raw, MSGPACK) == {"request_id": 3, "action": "echo", "params": {"message": "hi"}}
+    with pytest.raises(RPCError) as exc_info:
+        parse_request(b"\xc1", MSGPACK)
+    assert exc_info.value.code == "invalid_msgpack"
+
+
+def test_codec_join():
+    responses = [make_response(1, "ok", 3), RPCError(2, "unknown_action", "Unknown action 'x'").to_dict()]
+    for codec in (JSON, MSGPACK):
+        joined = codec.join([codec.dumps(response) for response in responses])
+        assert codec.loads(joined) == responses
+
+
+def test_codec_is_abstract():
+    with pytest.raises(TypeError):
+        Codec()
+
+
+def test_json_integer_range():
+    # Integers are 64-bit on the wire; orjson reads larger JSON integers as floats
+    raw = b'{"request_id": 1, "action": "add_numbers", "params": {"a": %d, "b": %d}}' % (INT_MAX, INT_MIN)
+    assert parse_request(raw)["params"] == {"a": INT_MAX, "b": INT_MIN}
+    request = parse_request(b'{"request_id": 1, "action": "add_numbers", "params": {"a": %d, "b": 1}}' % (INT_MAX + 1))
+    assert request["params"]["a"] == float(INT_MAX + 1)
+
+
+def test_parse_request_rejects_non_json():
+    for raw in (b"[" * 5000 + b"1234567890123456789" + b"]" * 5000,
+                b'{"request_id": "\\ud800", "action": "nope", "n": 1234567890123456789}',
+                b'{"request_id": 1, "action": "add_numbers", "params": {"a": NaN, "b": 1234567890123456789}}'):
+        with pytest.raises(RPCError) as exc_info:
+            parse_request(raw)
+        assert exc_info.value.code == "invalid_json"
@@ -0,0 +1,244 @@
+from server import handle_message, handle_connection, coalesce, encode_error
+from protocol import JSON, MSGPACK, RPCError, SUBPROTOCOLS
+from functions import register, FUNCTION_REGISTRY
+import asyncio
+import contextlib
+import msgpack
+import pytest
+import server
+import websockets
+
+
+@pytest.fixture
+def action():
+    """Register actions for one test, removing them again afterwards."""
+    names = []
+
+    def add(name, func, validate=None):
+        register(name, func, validate)
+        names.append(name)
+
+    yield add
+    for name in names:
+        del FUNCTION_REGISTRY[name]
+
+
+@contextlib.asynccontextmanager
+async def serving():
+    """Run the RPC server on a free port, yielding its URL."""
+    async with websockets.serve(handle_connection, "localhost", 0, subprotocols=list(SUBPROTOCOLS)) as ws_server:
+        yield f"ws://localhost:{ws_server.sockets[0].getsockname()[1]}"
+
+
+def request(request_id, action, **params):
+    return {"request_id": request_id, "action": action, "params": params}
+
+
+def test_handle_message():
+    reply = asyncio.run(handle_message(b'{"request_id": 1, "action": "add_numbers", "params": {"a": 1, "b": 2}}', JSON))
+    assert JSON.loads(reply) == {"request_id": 1, "status": "ok", "result": 3}
+
+
+def test_handle_message_errors():
+    for raw, code in ((b"not json", "invalid_json"),
+                      (b'{"request_id": 1, "action": "nope"}', "unknown_action"),
+                      (b'{"request_id": 1, "action": "add_numbers", "params": {"a": 1}}', "invalid_params")):
+        response = JSON.loads(asyncio.run(handle_message(raw, JSON)))
+        assert response["status"] == "error"
+        assert response["error"]["code"] == code
+
+
+def test_handle_message_batch():
+    raw = b'[{"request_id": 1, "action": "echo", "params": {"message": "hi"}}, 5, {"request_id": 2, "action": "nope"}]'
+    replies = asyncio.run(handle_message(raw, JSON))
+    ok, invalid, unknown = [JSON.loads(reply) for reply in replies]
+    assert ok == {"request_id": 1, "status": "ok", "result": "hi"}
+    assert invalid["error"]["code"] == "invalid_payload"
+    assert unknown["request_id"] == 2
+    assert unknown["error"]["code"] == "unknown_action"
+
+
+def test_coalesce():
+    first, second, third = (JSON.encode_result(i, i) for i in range(3))
+    # A lone reply goes out unchanged, anything else as one array
+    assert coalesce([first], JSON) is first
+    assert JSON.loads(coalesce([first, second], JSON)) == [JSON.loads(first), JSON.loads(second)]
+    assert JSON.loads(coalesce([[first]], JSON)) == [JSON.loads(first)]
+    assert JSON.loads(coalesce([first, [second, third]], JSON)) == [JSON.loads(r) for r in (first, second, third)]
+
+
+def test_result_out_of_range():
+    # 2**80 doesn't fit in the 64-bit integers the protocol supports
+    for codec in (JSON, MSGPACK):
+        raw = codec.dumps({"request_id": 1, "action": "multiply_numbers", "params": {"a": 2 ** 40, "b": 2 ** 40}})
+        response = codec.loads(asyncio.run(handle_message(raw, codec)))
+        assert response["request_id"] == 1
+        assert response["error"]["code"] == "invalid_params"
+
+
+def test_unencodable_result(action):
+    action("make_set", lambda: {1, 2})
+    response = JSON.loads(asyncio.run(handle_message(b'{"request_id": 1, "action": "make_set"}', JSON)))
+    assert response["request_id"] == 1
+    assert response["error"]["code"] == "server_error"
+
+    # One bad entry doesn't cost the rest of the batch their responses
+    raw = b'[{"request_id": 1, "action": "make_set"}, {"request_id": 2, "action": "add_numbers", "params": {"a": 1, "b": 2}}]'
+    first, second = [JSON.loads(reply) for reply in asyncio.run(handle_message(raw, JSON))]
+    assert first["error"]["code"] == "server_error"
+    assert second == {"request_id": 2, "status": "ok", "result": 3}
+
+
+def test_non_finite_result():
+    for codec in (JSON, MSGPACK):
+        raw = codec.dumps({"request_id": 1, "action": "add_numbers", "params": {"a": 1e308, "b": 1e308}})
+        response = codec.loads(asyncio.run(handle_message(raw, codec)))
+        assert response["request_id"] == 1
+        assert response["error"]["code"] == "server_error"
+
+
+def test_unencodable_error():
+    # A lone surrogate can't be encoded as UTF-8
+    response = JSON.loads(encode_error(RPCError("\ud800", "unknown_action", "Unknown action 'x'"), JSON))
+    assert response["request_id"] is None
+    assert response["error"]["code"] == "server_error"
+
+
+def test_fast_call_overtakes_slow(action):
+    async def wait(seconds):
+        await asyncio.sleep(seconds)
+        return seconds
+
+    action("wait", wait)
+
+    async def main():
+        async with serving() as url, websockets.connect(url) as ws:
+            await ws.send(JSON.dumps(request(1, "wait", seconds=0.5)))
+            await ws.send(JSON.dumps(request(2, "echo", message="hi")))
+            return [JSON.loads(await ws.recv())["request_id"] for _ in range(2)]
+
+    assert asyncio.run(main()) == [2, 1]
+
+
+def test_in_flight_limit(action, monkeypatch):
+    monkeypatch.setattr(server, "MAX_IN_FLIGHT", 2)
+    running = []
+    peak = 0
+    release = None
+
+    async def hold():
+        nonlocal peak
+        running.append(None)
+        peak = max(peak, len(running))
+        await release.wait()
+        running.pop()
+
+    action("hold", hold)
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        async with serving() as url, websockets.connect(url) as ws:
+            # A batch takes a slot per entry, so it fills both slots alone
+            await ws.send(JSON.dumps([request(1, "hold"), request(2, "hold")]))
+            for request_id in range(3, 6):
+                await ws.send(JSON.dumps(request(request_id, "hold")))
+            await asyncio.sleep(0.2)
+            assert len(running) == 2
+            release.set()
+            return [JSON.loads(await ws.recv()) for _ in range(4)]
+
+    replies = asyncio.run(main())
+    assert peak == 2
+    assert len(replies[0]) == 2
+    assert [reply["request_id"] for reply in replies[1:]] == [3, 4, 5]
+
+
+def test_batch_too_large(monkeypatch):
+    monkeypatch.setattr(server, "MAX_IN_FLIGHT", 2)
+    raw = JSON.dumps([request(i, "echo", message="hi") for i in range(3)])
+    response = JSON.loads(asyncio.run(handle_message(raw, JSON)))
+    assert response["error"]["code"] == "invalid_payload"
+
+
+def test_cancelled_on_disconnect(action):
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def hang():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    action("hang", hang)
+
+    async def main():
+        async with serving() as url:
+            async with websockets.connect(url) as ws:
+                await ws.send(JSON.dumps(request(1, "hang")))
+                await asyncio.wait_for(started.wait(), 1)
+            await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(main())
+
+
+def test_disconnect_while_waiting_for_slots(action, monkeypatch):
+    monkeypatch.setattr(server, "MAX_IN_FLIGHT", 1)
+    cancelled = []
+
+    async def hang():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(None)
+            raise
+
+    action("hang", hang)
+
+    async def main():
+        async with serving() as url:
+            async with websockets.connect(url) as ws:
+                # The second request waits for the slot the first one holds
+                for request_id in range(2):
+                    await ws.send(JSON.dumps(request(request_id, "hang")))
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(0.1)
+            assert cancelled
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+
+
+def test_coalescing_is_opt_in(action):
+    async def hold():
+        await release.wait()
+        return "done"
+
+    action("hold", hold)
+
+    async def frames(url, subprotocols):
+        async with websockets.connect(url, subprotocols=subprotocols) as ws:
+            for request_id in range(3):
+                await ws.send(JSON.dumps(request(request_id, "hold")))
+            await asyncio.sleep(0.1)
+            # All three replies become ready at the same time
+            release.set()
+            received = [JSON.loads(await ws.recv())]
+            with contextlib.suppress(asyncio.TimeoutError):
+                while True:
+                    received.append(JSON.loads(await asyncio.wait_for(ws.recv(), 0.2)))
+            release.clear()
+            return received
+
+    async def main():
+        async with serving() as url:
+            return await frames(url, None), await frames(url, ["rpc.json+coalesce"])
+
+    release = asyncio.Event()
+    plain, coalesced = asyncio.run(main())
+    # Without the subprotocol every reply is a frame of its own
+    assert [frame["request_id"] for frame in plain] == [0, 1, 2]
+    assert len(coalesced) == 1
+    assert [response["request_id"] for response in coalesced[0]] == [0, 1, 2]